@@ -1,142 +1,245 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse, PlainTextResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
 import logging
 import datetime
+from pydantic import TypeAdapter, ValidationError
 
 from app.models.house_purchase_request import HousePurchaseRequest
 from app.models.retirement_request import RetirementRequest
 from app.models.monthly_budget_request import MonthlyBudgetRequest
-from app.utils.ollama_utils import generate_ollama_stream, get_ollama_response_with_web
+from app.models.house_purchase_plan import HousePurchasePlan
+from app.models.retirement_plan import RetirementPlan
+from app.models.monthly_budget_plan import MonthlyBudgetPlan
+from app.utils.coalescing import StreamCoalescer, request_key
+from app.utils.compression import accepts_gzip, gzip_stream
+from app.utils.ollama_utils import close_ollama_client, create_ollama_client, generate_ollama_stream, get_ollama_response_with_web, prime_stream
+
+# System messages hold the static instructions so Ollama can reuse their prefill across requests,
+# per request values (including the date) only ever go in the user message
+HOUSE_PURCHASE_SYSTEM_MESSAGE = {
+    'role': 'system',
+    'content': """
+You are a financial assistant specializing in home purchases. Provide a detailed assessment of whether a potential home buyer can afford a home, and offer personalized recommendations.
+You will also have access to the Internet, please use this to find relevant data like costs of living and housing trends in the zip code. As well as up to date interest rates.
+
+Based on the buyer's details, fill in the following fields:
+
+- can_afford, price_range_low, price_range_high, affordability_reasoning: Determine if the buyer can realistically afford a home and come up with a price range, considering their income, debts, and assets. Explain your reasoning.
+- estimated_interest_rate, estimated_monthly_mortgage_payment: Calculate the estimated monthly mortgage payment (principal and interest) for a home in their price range, using the current interest rate for their credit score.
+- estimated_annual_property_taxes: Provide an estimate of annual property taxes for the given zip code. (Use a reasonable estimate if exact data isn't available.)
+- estimated_annual_homeowners_insurance: Provide an estimate for annual homeowners insurance.
+- total_estimated_monthly_housing_costs: Calculate the total estimated monthly housing costs (mortgage, property taxes, insurance).
+- recommendations: Offer personalized recommendations to the buyer, such as:
+    - Whether they should adjust their desired home price range.
+    - Strategies for improving their financial situation (e.g., reducing debt, increasing savings).
+    - Advice on securing a mortgage.
+
+Respond with JSON only, matching the provided schema. Use a professional tone, but limit wording as much as possible so users can get a quick response.
+""",
+}
+
+HOUSE_PURCHASE_PROMPT_TEMPLATE = """
+Please note that the current date is {current_date}.
+
+Here are the buyer's details:
+- Income: ${income} per year
+- Total Monthly Debt: ${total_monthly_debt}
+- Total Liquid Assets: ${total_liquid_assets}
+- Zip Code: {zip_code} (for local property tax estimation)
+- Credit Score: {credit_score} (for interest rate, in addition to current trends)
+- User input: {user_input} (if applicable)
+"""
+
+MONTHLY_BUDGET_SYSTEM_MESSAGE = {
+    'role': 'system',
+    'content': """
+You are a financial assistant specializing in budgets. Please provide a brief sample monthly budget recommendation based on their income, debt, and personal preferences.
+You will also have access to the Internet, please use this to find relevant data like costs of living in the zip code.
+
+Based on the client's details, fill in the following fields:
+
+- monthly_costs, monthly_costs_reasoning: Estimate how much of their income should go to important categories like housing, saving/investing, utilities, subscriptions, food, healthcare, ect.
+    Feel free to include other categories especially if user input is provided. Explain your reasoning.
+- housing_payment_low, housing_payment_high: Give the client a range of how much they can spend on housing. You can leave out things like rate information, just focus on a payment range for now.
+- savings_and_investing: Provide an estimate of what kinds of things the client can do by investing their income, for example if you save 10% for retirement or have some sort of custom goal.
+- estimated_annual_homeowners_insurance: Provide an estimate for annual homeowners insurance.
+- recommendations: Offer personalized recommendations to the buyer, such as:
+    - Whether their income is sufficient for the location and household size
+    - Strategies for improving their financial situation (e.g., reducing debt, cutting certain costs).
+
+Respond with JSON only, matching the provided schema. Use a professional tone, but limit wording as much as possible so users can get a quick response.
+""",
+}
+
+MONTHLY_BUDGET_PROMPT_TEMPLATE = """
+Please note that the current date is {current_date}.
+
+Here are the buyer's details:
+- Income: ${income} per year
+- Household Size: {household_size} people
+- Total Monthly Debt: ${total_monthly_debt}
+- Zip Code: {zip_code} (for local property tax estimation)
+- User input: {user_input} (if applicable)
+"""
+
+RETIREMENT_SYSTEM_MESSAGE = {
+    'role': 'system',
+    'content': """
+You are a financial assistant providing retirement planning advice. A client will provide their current age, retirement age, savings, investments, income, and retirement income goals.
+
+Based on this information, please provide a concise retirement plan by filling in the following fields:
+
+- total_savings_needed: Calculate the total amount of savings the client will need at retirement to maintain their desired income, considering inflation.
+- annual_savings_rate_percent: Determine the annual savings rate (as a percentage of income) the client needs to achieve their retirement goal.
+- investment_strategy: Suggest a general investment strategy (e.g., diversified portfolio of stocks and bonds) that aligns with their risk tolerance and time horizon.
+- additional_considerations: Offer any additional advice or recommendations, such as reducing debt or maximizing contributions to retirement accounts.
+- is_feasible, feasibility_summary: Most importantly, we want the user to know if their retirement plan is realistic or needs additional suggestions to be feasible.
+
+Respond with JSON only, matching the provided schema. Limit wording as much as possible for quick understanding.
+""",
+}
+
+RETIREMENT_PROMPT_TEMPLATE = """
+A client has provided the following information:
+
+- Current Age: {current_age} in years
+- Retirement Age: {retirement_age} in years
+- Current Cash Savings: ${current_savings}
+- Current Investments: ${current_investments}
+- Supplemental Income In Retirement: ${supplemental_retirement_income} (If applicable, does not include social security, please estimate this on your own in addition)
+- Annual Income: ${annual_income} per year
+- Desired Annual Income in Retirement: ${desired_annual_income_in_retirement} per year
+- User input: {user_input} (if applicable)
+"""
+
+# Responses are constrained to these schemas, which keeps output short and easy to parse
+HOUSE_PURCHASE_PLAN_SCHEMA = HousePurchasePlan.model_json_schema()
+MONTHLY_BUDGET_PLAN_SCHEMA = MonthlyBudgetPlan.model_json_schema()
+RETIREMENT_PLAN_SCHEMA = RetirementPlan.model_json_schema()
+
+# Validators are built once and run on the raw body, skipping FastAPI's per-call body handling
+HOUSE_PURCHASE_REQUEST_ADAPTER = TypeAdapter(HousePurchaseRequest)
+MONTHLY_BUDGET_REQUEST_ADAPTER = TypeAdapter(MonthlyBudgetRequest)
+RETIREMENT_REQUEST_ADAPTER = TypeAdapter(RetirementRequest)
+
+
+def json_body(model) -> dict:
+    """OpenAPI description of a JSON request body, for endpoints that validate the raw body themselves."""
+    return {'requestBody': {'required': True, 'content': {'application/json': {'schema': model.model_json_schema()}}}}
+
+
+async def validate_body(http_request: Request, adapter: TypeAdapter):
+    try:
+        return adapter.validate_json(await http_request.body())
+    except ValidationError as e:
+        # Same 422 response FastAPI gives for an invalid body parameter, including the "body" location prefix
+        raise RequestValidationError([{**error, 'loc': ('body', *error['loc'])} for error in e.errors(include_url=False)])
+
+
+def stream_response(http_request: Request, stream) -> StreamingResponse:
+    """Stream generated JSON to the client, gzipped when it accepts that encoding."""
+    headers = {'Vary': 'Accept-Encoding'}
+    if accepts_gzip(http_request.headers.get('accept-encoding', '')):
+        headers['Content-Encoding'] = 'gzip'
+        stream = gzip_stream(stream)
+    return StreamingResponse(stream, media_type="application/json", headers=headers)
+
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging, unless the server (or another import) already has
+if not logging.getLogger().handlers:
+    logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
 
-@app.post("/plan-home-purchase", response_class=PlainTextResponse)
-def generate_house_purchase_plan(request: HousePurchaseRequest):
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the Ollama client once so connections are reused across requests
+    app.state.ollama = create_ollama_client()
+    # Identical requests in flight at the same time share a single generation
+    app.state.inflight = StreamCoalescer()
+    yield
+    await close_ollama_client(app.state.ollama)
+
+
+app = FastAPI(lifespan=lifespan)
+
+@app.post("/plan-home-purchase", openapi_extra=json_body(HousePurchaseRequest))
+async def generate_house_purchase_plan(http_request: Request):
+    request = await validate_body(http_request, HOUSE_PURCHASE_REQUEST_ADAPTER)
     try:
-        prompt = f"""
-        You are a financial assistant specializing in home purchases. Provide a detailed assessment of whether a potential home buyer can afford a home, and offer personalized recommendations.
-        Please note that the current date is ${datetime.datetime.now().isoformat()}.
-        You will also have access to the Internet, please use this to find relevant data like costs of living and housing trends in the zip code. As well as up to date interest rates.
-
-        Here are the buyer's details:
-        - Income: {request.income} per year
-        - Total Monthly Debt: {request.total_monthly_debt}
-        - Total Liquid Assets: {request.total_liquid_assets}
-        - Zip Code: {request.zip_code} (for local property tax estimation)
-        - Credit Score: {request.credit_score} (for interest rate, in addition to current trends)
-        - User input: {request.user_input} (if applicable)
-
-        Based on this information, please provide the following:
-
-        1. **Affordability Assessment:**  Determine if the buyer can realistically afford a home and come up with a price range, considering their income, debts, and assets. Explain your reasoning.
-        2. **Estimated Monthly Mortgage Payment:** Calculate the estimated monthly mortgage payment (principal and interest) for a home in their price range, using the provided interest rate.
-        3. **Estimated Property Taxes:** Provide an estimate of annual property taxes for the given zip code. (Use a reasonable estimate if exact data isn't available.)
-        4. **Estimated Homeowners Insurance:** Provide an estimate for annual homeowners insurance.
-        5. **Total Estimated Monthly Housing Costs:** Calculate the total estimated monthly housing costs (mortgage, property taxes, insurance).
-        6. **Recommendations:** Offer personalized recommendations to the buyer, such as:
-            - Whether they should adjust their desired home price range.
-            - Strategies for improving their financial situation (e.g., reducing debt, increasing savings).
-            - Advice on securing a mortgage.
-
-        Please provide a clear and concise assessment, using a professional tone, but limit wording as much as possible so users can get a quick response.
-        """
+        prompt = HOUSE_PURCHASE_PROMPT_TEMPLATE.format_map({**request.model_dump(), "current_date": datetime.date.today().isoformat()})
         messages = [
+            HOUSE_PURCHASE_SYSTEM_MESSAGE,
             {
                 'role': 'user',
                 'content': prompt,
             }
         ]
 
-        return get_ollama_response_with_web(logger, messages, request.model)
+        # The tool rounds run before the first chunk, so their errors still become error responses
+        stream = await prime_stream(app.state.inflight.stream(
+            request_key("plan-home-purchase", request),
+            lambda: get_ollama_response_with_web(logger, app.state.ollama, messages, request.model, HOUSE_PURCHASE_PLAN_SCHEMA)
+        ))
+        return stream_response(http_request, stream)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Exception processing:")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/plan-monthly-budget", response_class=PlainTextResponse)
-def generate_monthly_budget_plan(request: MonthlyBudgetRequest):
+@app.post("/plan-monthly-budget", openapi_extra=json_body(MonthlyBudgetRequest))
+async def generate_monthly_budget_plan(http_request: Request):
+    request = await validate_body(http_request, MONTHLY_BUDGET_REQUEST_ADAPTER)
     try:
-        prompt = f"""
-        You are a financial assistant specializing in budgets. Please provide a brief sample monthly budget recommendation based on their income, debt, and personal preferences.
-        Please note that the current date is ${datetime.datetime.now().isoformat()}.
-        You will also have access to the Internet, please use this to find relevant data like costs of living in the zip code.
-
-        Here are the buyer's details:
-        - Income: {request.income} per year
-        - Household Size: {request.household_size} people
-        - Total Monthly Debt: {request.total_monthly_debt}
-        - Zip Code: {request.zip_code} (for local property tax estimation)
-        - User input: {request.user_input} (if applicable)
-
-        Based on this information, please provide the following:
-
-        1. **Monthly costs breakdown:**  Estimate how much of their income should go to important categories like housing, saving/investing, utilities, subscriptions, food, healthcare, ect.
-            Feel free to include other categories especially if user input is provided. Explain your reasoning.
-        2. **Estimated Monthly Housing Payment:** Give the client a range of how much they can spend on housing. You can leave out things like rate information, just focus on a payment range for now.
-        3. **Estimated Savings and Investing:** Provide an estimate of what kinds of things the client can do by investing their income, for example if you save 10% for retirement or have some sort of custom goal.
-        4. **Estimated Homeowners Insurance:** Provide an estimate for annual homeowners insurance.
-        5. **Recommendations:** Offer personalized recommendations to the buyer, such as:
-            - Whether their income is sufficient for the location and household size
-            - Strategies for improving their financial situation (e.g., reducing debt, cutting certain costs).
-
-        Please provide a clear and concise assessment, using a professional tone, but limit wording as much as possible so users can get a quick response.
-        """
+        prompt = MONTHLY_BUDGET_PROMPT_TEMPLATE.format_map({**request.model_dump(), "current_date": datetime.date.today().isoformat()})
         messages = [
+            MONTHLY_BUDGET_SYSTEM_MESSAGE,
             {
                 'role': 'user',
                 'content': prompt,
             }
         ]
 
-        return get_ollama_response_with_web(logger, messages, request.model)
+        # The tool rounds run before the first chunk, so their errors still become error responses
+        stream = await prime_stream(app.state.inflight.stream(
+            request_key("plan-monthly-budget", request),
+            lambda: get_ollama_response_with_web(logger, app.state.ollama, messages, request.model, MONTHLY_BUDGET_PLAN_SCHEMA)
+        ))
+        return stream_response(http_request, stream)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Exception processing:")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/plan-retirement")
-def generate_house_purchase_plan(request: RetirementRequest):
+@app.post("/plan-retirement", openapi_extra=json_body(RetirementRequest))
+async def generate_retirement_plan(http_request: Request):
+    request = await validate_body(http_request, RETIREMENT_REQUEST_ADAPTER)
     try:
-        prompt = f"""
-        You are a financial assistant providing retirement planning advice. A client has provided the following information:
-
-        - Current Age: {request.current_age} in years
-        - Retirement Age: {request.retirement_age} in years
-        - Current Cash Savings: ${request.current_savings}
-        - Current Investments: ${request.current_investments}
-        - Supplemental Income In Retirement: ${request.supplemental_retirement_income} (If applicable, does not include social security, please estimate this on your own in addition)
-        - Annual Income: ${request.annual_income} per year
-        - Desired Annual Income in Retirement: ${request.desired_annual_income_in_retirement} per year
-        - User input: ${request.user_input} (if applicable)
-
-        Based on this information, please provide a concise retirement plan addressing the following:
-
-        1.  **Estimated Total Savings Needed at Retirement:** Calculate the total amount of savings the client will need at retirement to maintain their desired income, considering inflation.
-        2.  **Annual Savings Required:** Determine the annual savings rate (as a percentage of income) the client needs to achieve their retirement goal.
-        3.  **Investment Strategy:** Suggest a general investment strategy (e.g., diversified portfolio of stocks and bonds) that aligns with their risk tolerance and time horizon.
-        4.  **Additional Considerations:** Offer any additional advice or recommendations, such as reducing debt or maximizing contributions to retirement accounts.
-        5.  **If Feasible/On track:** Most importantly, we want the user to know if their retirement plan is realistic or needs additional suggestions to be feasible.
-
-        Please present your response in a clear and easy-to-understand format. Limit wording as much as possible for quick understanding.
-        """
+        prompt = RETIREMENT_PROMPT_TEMPLATE.format_map(request.model_dump())
         messages = [
+            RETIREMENT_SYSTEM_MESSAGE,
             {
                 'role': 'user',
                 'content': prompt,
             },
         ]
 
-        return StreamingResponse(
-            generate_ollama_stream(messages, request.model),
-            media_type="text/plain"
+        stream = app.state.inflight.stream(
+            request_key("plan-retirement", request),
+            lambda: generate_ollama_stream(app.state.ollama, messages, request.model, RETIREMENT_PLAN_SCHEMA)
         )
+        return stream_response(http_request, stream)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Exception processing:")
         raise HTTPException(status_code=500, detail=str(e))
@@ -144,4 +247,5 @@ def generate_house_purchase_plan(request: RetirementRequest):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvloop and httptools speed up token streaming, workers require an import string
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools", workers=2)
\ No newline at end of file
@@ -0,0 +1,13 @@
+from pydantic import BaseModel
+
+class HousePurchasePlan(BaseModel):
+    can_afford: bool
+    price_range_low: float
+    price_range_high: float
+    affordability_reasoning: str
+    estimated_interest_rate: float
+    estimated_monthly_mortgage_payment: float
+    estimated_annual_property_taxes: float
+    estimated_annual_homeowners_insurance: float
+    total_estimated_monthly_housing_costs: float
+    recommendations: list[str]
\ No newline at end of file
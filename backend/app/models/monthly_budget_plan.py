@@ -0,0 +1,14 @@
+from pydantic import BaseModel
+
+class BudgetCategory(BaseModel):
+    name: str
+    monthly_amount: float
+
+class MonthlyBudgetPlan(BaseModel):
+    monthly_costs: list[BudgetCategory]
+    monthly_costs_reasoning: str
+    housing_payment_low: float
+    housing_payment_high: float
+    savings_and_investing: str
+    estimated_annual_homeowners_insurance: float
+    recommendations: list[str]
\ No newline at end of file
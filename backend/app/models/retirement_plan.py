@@ -0,0 +1,9 @@
+from pydantic import BaseModel
+
+class RetirementPlan(BaseModel):
+    is_feasible: bool
+    feasibility_summary: str
+    total_savings_needed: float
+    annual_savings_rate_percent: float
+    investment_strategy: str
+    additional_considerations: list[str]
\ No newline at end of file
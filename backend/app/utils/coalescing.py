@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import json
+from pydantic import BaseModel
+
+
+def request_key(endpoint: str, request: BaseModel) -> str:
+    """Key identifying identical requests to an endpoint."""
+    canonical = json.dumps(request.model_dump(), sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(f'{endpoint}:{canonical}'.encode(), digest_size=16).hexdigest()
+
+
+class StreamCoalescer:
+    """Shares one generation between identical requests that are in flight at the same time.
+
+    The first request for a key starts the stream, later ones replay what has been generated so far
+    and then follow along. The key is released once the stream finishes, or once every subscriber
+    has gone away, in which case the generation is cancelled.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def stream(self, key: str, start_stream):
+        """Subscribe to the stream for key, calling start_stream() to create it if none is in flight."""
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = _Flight(start_stream(), on_abandoned=lambda: self._release(key, flight))
+            self._inflight[key] = flight
+            flight.task.add_done_callback(lambda _: self._release(key, flight))
+        # Counted as soon as it is handed out, the caller may not start iterating right away
+        return _Subscription(flight)
+
+    def _release(self, key: str, flight: '_Flight'):
+        # A newer flight may already hold the key
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+
+
+class _Flight:
+    def __init__(self, stream, on_abandoned):
+        self.chunks = []
+        self.error = None
+        self.done = False
+        self.subscribers = 0
+        self._on_abandoned = on_abandoned
+        self._changed = asyncio.Condition()
+        # Runs in its own task so the generation survives any single client disconnecting
+        self.task = asyncio.create_task(self._produce(stream))
+
+    async def _produce(self, stream):
+        try:
+            async for chunk in stream:
+                async with self._changed:
+                    self.chunks.append(chunk)
+                    self._changed.notify_all()
+        except asyncio.CancelledError:
+            # Anyone still reading must not mistake a cut off stream for a complete one
+            self.error = RuntimeError("Stream was cancelled before it finished")
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    async def chunk_at(self, index: int):
+        """Wait for the chunk at index, raising StopAsyncIteration (or the stream's error) past the end."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: index < len(self.chunks) or self.done)
+            if index < len(self.chunks):
+                return self.chunks[index]
+        if self.error:
+            # Each subscriber gets its own copy so tracebacks don't pile up on a shared instance
+            raise _copy_exception(self.error) from self.error
+        raise StopAsyncIteration
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if not self.subscribers and not self.done:
+            # Every client disconnected, stop generating for nobody
+            self._on_abandoned()
+            self.task.cancel()
+
+
+class _Subscription:
+    """Async iterator over a flight's chunks that holds one subscriber count until it finishes or is dropped."""
+
+    def __init__(self, flight: _Flight):
+        self._flight = flight
+        self._index = 0
+        self._released = False
+        flight.subscribers += 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._flight.chunk_at(self._index)
+        except BaseException:
+            # End of stream, the stream's error, or the reader being cancelled (e.g. on disconnect)
+            self.release()
+            raise
+        self._index += 1
+        return chunk
+
+    async def aclose(self):
+        self.release()
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._flight.unsubscribe()
+
+    def __del__(self):
+        self.release()
+
+
+def _copy_exception(error: Exception) -> Exception:
+    copied = type(error).__new__(type(error), *error.args)
+    copied.args = error.args
+    copied.__dict__.update(error.__dict__)
+    return copied
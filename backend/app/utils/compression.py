@@ -0,0 +1,38 @@
+import zlib
+
+# Flush at least this many bytes at a time, flushing every token would cost more than it saves
+GZIP_FLUSH_SIZE = 256
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip, honouring q-values (q=0 means refused)."""
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.lower()] = quality
+    # An explicit gzip entry wins over the * wildcard
+    quality = qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0.0)))
+    return quality > 0
+
+
+async def gzip_stream(stream):
+    """Gzip a byte stream, flushing at line breaks so the client still receives text as it is generated."""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # gzip container
+    pending = 0
+    async for chunk in stream:
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if b"\n" in chunk or pending >= GZIP_FLUSH_SIZE:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
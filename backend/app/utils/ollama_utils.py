@@ -1,50 +1,195 @@
+import asyncio
+import json
 import logging
+import httpx
 import ollama
+from cachetools import TTLCache
+from fastapi import HTTPException
+from pydantic import BaseModel
 from ollama import web_search, web_fetch
 
-async def generate_ollama_stream(messages: list, model: str):
-    """Generator function to stream response chunks from Ollama."""
+OLLAMA_TIMEOUT = 300
+OLLAMA_LIMITS = httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30)
+# Tool results are truncated for limited context lengths
+TOOL_RESULT_LIMIT = 8000 * 4
+# Bounds on the tool loop so a misbehaving model can't hold a request (and grow its context) forever
+MAX_TOOL_ROUNDS = 6
+TOOL_ROUND_TIMEOUT = 120
+# Once a round starts streaming the answer it gets longer, the answer is cut off rather than failed past this
+ANSWER_TIMEOUT = 600
+# Once this many rounds have run, results the model has already read are cut down to keep prefill short
+COMPRESS_TOOL_RESULTS_AFTER = 3
+COMPRESSED_TOOL_RESULT_LIMIT = 500
+
+# Web tools offered to the model, and their implementations by name
+_TOOLS = (ollama.web_search, ollama.web_fetch)
+_TOOL_MAP = {'web_search': web_search, 'web_fetch': web_fetch}
+
+# Many users trigger identical searches (e.g. for the same zip code), so results are shared for an hour
+_tool_cache = TTLCache(maxsize=1024, ttl=3600)
+_tool_cache_lock = asyncio.Lock()
+
+
+def create_ollama_client() -> ollama.AsyncClient:
+    """Create an async Ollama client backed by a pool of keep-alive connections."""
+    # Extra kwargs are handed to the underlying httpx client, host falls back to OLLAMA_HOST.
+    # HTTP/2 is left off, httpx only negotiates it over TLS and Ollama is served over plain http
+    # Requests share this client and reach Ollama concurrently, its scheduler batches them (OLLAMA_NUM_PARALLEL)
+    return ollama.AsyncClient(timeout=OLLAMA_TIMEOUT, limits=OLLAMA_LIMITS)
+
+
+async def close_ollama_client(client: ollama.AsyncClient):
+    """Close the pooled connections of a client made by create_ollama_client."""
+    # AsyncClient has no public close across the ollama versions we support, so this is the one
+    # place that reaches into the httpx client it wraps
+    await client._client.aclose()
+
+
+async def generate_ollama_stream(client: ollama.AsyncClient, messages: list, model: str, response_format: dict | None = None):
+    """Generator function to stream response chunks from Ollama, optionally constrained to a JSON schema."""
     
     # Streaming was working well for this use case
-    stream = ollama.chat(
+    stream = await client.chat(
         model=model,
         messages=messages,
+        format=response_format,
         stream=True
     )
-    for chunk in stream:
-        # Yield each content chunk as a string
-        yield chunk.message.content
-
-
-def get_ollama_response_with_web(logger: logging.Logger, messages: list, model: str):
-    """Use Ollama to generate responses using the web when appropriate."""
-    available_tools = {'web_search': web_search, 'web_fetch': web_fetch}
-
-    while True:
-        response = ollama.chat(
-            model=model,
-            messages=messages,
-            think=True,
-            tools=[ollama.web_search, ollama.web_fetch]
-        )
-        if response.message.thinking:
-            logger.info('Thinking: ', response.message.thinking)
-        if response.message.content:
-            logger.info('Content: ', response.message.content)
-        messages.append(response.message)
-        if response.message.tool_calls:
-            logger.info('Tool calls: ', response.message.tool_calls)
-            for tool_call in response.message.tool_calls:
-                function_to_call = available_tools.get(tool_call.function.name)
-            if function_to_call:
-                args = tool_call.function.arguments
-                result = function_to_call(**args)
-                logger.info('Result: ', str(result)[:200]+'...')
-                # Result is truncated for limited context lengths
-                messages.append({'role': 'tool', 'content': str(result)[:8000 * 4], 'tool_name': tool_call.function.name})
-            else:
+    async for chunk in stream:
+        # Yield encoded bytes so StreamingResponse can send them without re-encoding
+        if chunk.message.content:
+            yield chunk.message.content.encode("utf-8")
+
+
+def _truncate(result, limit: int = TOOL_RESULT_LIMIT) -> str:
+    """Serialize a tool result to text, keeping at most limit characters."""
+    if isinstance(result, str):
+        text = result
+    elif isinstance(result, BaseModel):
+        # Ollama web tools return pydantic models, dump them directly rather than through their repr
+        text = result.model_dump_json()
+    else:
+        text = json.dumps(result, default=str)
+    return text[:limit]
+
+
+async def call_tool_cached(name: str, function_to_call, args: dict) -> str:
+    """Call a synchronous tool off the event loop, reusing recent results for identical arguments."""
+    key = (name, tuple(sorted(args.items())))
+    async with _tool_cache_lock:
+        if key in _tool_cache:
+            return _tool_cache[key]
+
+    result = await asyncio.to_thread(function_to_call, **args)
+    result = _truncate(result)
+    async with _tool_cache_lock:
+        _tool_cache[key] = result
+    return result
+
+
+def _compress_tool_results(messages: list):
+    """Shorten tool results from previous rounds, the model has already seen them in full."""
+    for message in messages:
+        if isinstance(message, dict) and message['role'] == 'tool':
+            message['content'] = message['content'][:COMPRESSED_TOOL_RESULT_LIMIT]
+
+
+async def prime_stream(stream):
+    """Wait for the first chunk of a stream so errors raised before any output still produce an error response."""
+    try:
+        first_chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+
+    async def primed():
+        if first_chunk is None:
+            return
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+
+    return primed()
+
+
+async def get_ollama_response_with_web(logger: logging.Logger, client: ollama.AsyncClient, messages: list, model: str, response_format: dict | None = None):
+    """Use Ollama to generate responses using the web when appropriate, streaming the final answer as it is generated.
+
+    Every round is streamed with the tools offered. A round whose content arrives before any tool call is the
+    answer and is sent on as it is generated, content from tool rounds never reaches the client.
+    When response_format is a JSON schema the answer is constrained to it.
+    """
+    loop = asyncio.get_running_loop()
+    for round_number in range(MAX_TOOL_ROUNDS):
+        thinking, content, tool_calls = [], [], []
+        answering = False
+        # Deadlines are checked per read, a timeout around the whole loop would span yields to the consumer
+        deadline = loop.time() + TOOL_ROUND_TIMEOUT
+        try:
+            async with asyncio.timeout_at(deadline):
+                stream = await client.chat(
+                    model=model,
+                    messages=messages,
+                    think=True,
+                    tools=_TOOLS,
+                    format=response_format,
+                    stream=True
+                )
+            while True:
+                async with asyncio.timeout_at(deadline):
+                    try:
+                        chunk = await stream.__anext__()
+                    except StopAsyncIteration:
+                        break
+                if chunk.message.thinking:
+                    thinking.append(chunk.message.thinking)
+                if chunk.message.tool_calls:
+                    if answering:
+                        logger.warning('Ignoring tool calls made after the answer started: %s', chunk.message.tool_calls)
+                    else:
+                        tool_calls.extend(chunk.message.tool_calls)
+                if chunk.message.content:
+                    content.append(chunk.message.content)
+                    if not answering and not tool_calls:
+                        # Content before any tool call means this round is the answer, start sending it
+                        answering = True
+                        deadline = loop.time() + ANSWER_TIMEOUT
+                    if answering:
+                        yield chunk.message.content.encode("utf-8")
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            if not answering:
+                raise HTTPException(status_code=504, detail="Timed out waiting for the model")
+            # The response has already started, so all that is left is to end it early
+            logger.warning('Answer cut off after %s seconds', ANSWER_TIMEOUT)
+            return
+
+        if thinking:
+            logger.info('Thinking: %s', ''.join(thinking))
+        if content:
+            logger.info('Content: %s', ''.join(content))
+        if answering or not tool_calls:
+            return
+
+        messages.append({'role': 'assistant', 'content': ''.join(content), 'thinking': ''.join(thinking), 'tool_calls': tool_calls})
+        logger.info('Tool calls: %s', tool_calls)
+        if round_number + 1 >= COMPRESS_TOOL_RESULTS_AFTER:
+            _compress_tool_results(messages)
+        functions_to_call = [_TOOL_MAP.get(tool_call.function.name) for tool_call in tool_calls]
+        # Tools are independent, run them concurrently
+        results = iter(await asyncio.gather(
+            *(call_tool_cached(tool_call.function.name, function_to_call, tool_call.function.arguments)
+              for tool_call, function_to_call in zip(tool_calls, functions_to_call) if function_to_call),
+            return_exceptions=True
+        ))
+        for tool_call, function_to_call in zip(tool_calls, functions_to_call):
+            if not function_to_call:
                 messages.append({'role': 'tool', 'content': f'Tool {tool_call.function.name} not found', 'tool_name': tool_call.function.name})
-        else:
-            break
-            
-    return messages[-1].content
\ No newline at end of file
+                continue
+            result = next(results)
+            if isinstance(result, Exception):
+                logger.warning('Tool %s failed: %s', tool_call.function.name, result)
+                messages.append({'role': 'tool', 'content': f'Tool {tool_call.function.name} failed: {result}', 'tool_name': tool_call.function.name})
+                continue
+            logger.info('Result: %.200s...', result)
+            messages.append({'role': 'tool', 'content': result, 'tool_name': tool_call.function.name})
+
+    raise HTTPException(status_code=504, detail=f"Model did not finish within {MAX_TOOL_ROUNDS} tool rounds")
@@ -0,0 +1 @@
+# Makes pytest put backend/ on sys.path so tests can import the app package like the server does
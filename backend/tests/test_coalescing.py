@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from app.utils.coalescing import StreamCoalescer
+
+
+class Generation:
+    """Fake model stream that records how often it was started and whether it was cancelled."""
+
+    def __init__(self, chunks=10, delay=0.01, error=None):
+        self.chunks = chunks
+        self.delay = delay
+        self.error = error
+        self.starts = 0
+        self.cancelled = False
+
+    async def stream(self):
+        self.starts += 1
+        try:
+            for i in range(self.chunks):
+                await asyncio.sleep(self.delay)
+                yield i
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_identical_requests_share_one_generation():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        generation = Generation(chunks=3)
+        first = asyncio.create_task(collect(coalescer.stream('key', generation.stream)))
+        await asyncio.sleep(0.015)
+        second = asyncio.create_task(collect(coalescer.stream('key', generation.stream)))
+        assert await first == [0, 1, 2]
+        assert await second == [0, 1, 2]
+        assert generation.starts == 1
+
+    asyncio.run(scenario())
+
+
+def test_joined_subscriber_keeps_stream_when_first_disconnects():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        generation = Generation(chunks=10)
+        first = coalescer.stream('key', generation.stream)
+        # Handed out but not iterated yet, like a StreamingResponse that hasn't started
+        second = coalescer.stream('key', generation.stream)
+        assert await first.__anext__() == 0
+        await first.aclose()
+        assert await collect(second) == list(range(10))
+        assert not generation.cancelled
+
+    asyncio.run(scenario())
+
+
+def test_generation_is_cancelled_when_every_subscriber_leaves():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        generation = Generation(chunks=100)
+        reader = asyncio.create_task(collect(coalescer.stream('key', generation.stream)))
+        await asyncio.sleep(0.05)
+        reader.cancel()
+        await asyncio.sleep(0.02)
+        assert generation.cancelled
+        # The key is free again, so the next request starts a fresh generation
+        assert await collect(coalescer.stream('key', Generation(chunks=2).stream)) == [0, 1]
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_generation_fails_subscribers_loudly():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        generation = Generation(chunks=100)
+        subscription = coalescer.stream('key', generation.stream)
+        assert await subscription.__anext__() == 0
+        # e.g. server shutdown cancelling the producer underneath a live subscriber
+        subscription._flight.task.cancel()
+        with pytest.raises(RuntimeError, match='cancelled'):
+            await collect(subscription)
+
+    asyncio.run(scenario())
+
+
+def test_each_subscriber_gets_its_own_error():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        generation = Generation(chunks=2, error=ValueError('model failed'))
+        subscriptions = [coalescer.stream('key', generation.stream) for _ in range(2)]
+        errors = []
+        for subscription in subscriptions:
+            with pytest.raises(ValueError, match='model failed') as info:
+                await collect(subscription)
+            errors.append(info.value)
+        assert errors[0] is not errors[1]
+        assert errors[0].__cause__ is errors[1].__cause__
+        assert generation.starts == 1
+
+    asyncio.run(scenario())